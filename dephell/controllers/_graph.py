@@ -1,7 +1,8 @@
 # built-in
-from collections import ChainMap
+from collections import defaultdict, deque
+from itertools import count
 from logging import getLogger
-from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Set, Tuple
 
 # app
 from ..imports import lazy_import
@@ -22,6 +23,12 @@ graphviz_backend = lazy_import('graphviz.backend')  # noqa: F811
 logger = getLogger(__name__)
 
 
+def _quote(text: str) -> str:
+    """Make double-quoted DOT ID from the given text.
+    """
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
 class Layer:
     _mapping: Dict[str, Any]
 
@@ -48,10 +55,13 @@ class Layer:
 
         raise KeyError('Dependency already added in layer: ' + dep.name)
 
-    def clear(self) -> None:
-        for name, dep in self._mapping.copy().items():
-            if not dep.used:
-                del self._mapping[name]
+    def clear(self) -> list:
+        """Drop all unused deps from the layer and return them.
+        """
+        dropped = [dep for dep in self._mapping.values() if not dep.used]
+        for dep in dropped:
+            del self._mapping[dep.name]
+        return dropped
 
     def copy(self) -> 'Layer':
         return type(self)(self.level, *self._mapping.values())
@@ -77,126 +87,201 @@ class Layer:
 
 
 class Graph:
+    """Change `applied` of deps in graph only by `mark_applied` and `mark_unapplied`.
+    """
     conflict: Optional[Dependency] = None
     _layers: List[Layer]
+    _deps: Dict[str, Any]
+    # (level, insertion number) for every dep, to keep leafs in layers order
+    _positions: Dict[str, Tuple[int, int]]
+    # the lowest level of every name, to find the layer of parents in `add`
+    _lowest_levels: Dict[str, int]
+    # names of deps that can be not applied yet
+    _leafs: Set[str]
 
     def __init__(self, *roots: RootDependency) -> None:
         for root in roots:
             if not root.dependencies:
                 logger.warning('empty root passed')
         self._roots = list(roots)
+        self._root_ids = {id(root) for root in roots}
         self._layers = []
         self.reset()
 
     def reset(self) -> None:
         self._layers = [Layer(0, *self._roots)]
-        self._deps = ChainMap(*[layer._mapping for layer in self._layers])
+        self._deps = dict()
+        self._positions = dict()
+        self._lowest_levels = dict()
+        self._leafs = set()
+        self._counter = count()
+        for layer in self._layers:
+            for name in layer._mapping:
+                self._index(layer, name)
         self.conflict = None
 
     def clear(self) -> None:
         """Drop from graph all deps that isn't required for roots.
         """
         for layer in self._layers[1:]:
-            layer.clear()
+            for dep in layer.clear():
+                levels = [other.level for other in self._layers if dep.name in other]
+                if levels:
+                    self._lowest_levels[dep.name] = min(levels)
+                else:
+                    del self._lowest_levels[dep.name]
+                if self._deps.get(dep.name) is not dep:
+                    continue
+                del self._deps[dep.name]
+                del self._positions[dep.name]
+                self._leafs.discard(dep.name)
+                # the dep could shadow a dep with the same name from a lower layer
+                for other_layer in reversed(self._layers):
+                    if dep.name in other_layer:
+                        self._index(other_layer, dep.name)
+                        break
 
     def add(self, dep, *, level: Optional[int] = None) -> None:
         if isinstance(dep, RootDependency):
             self._layers[0].add(dep)
             self._roots.append(dep)
+            self._root_ids.add(id(dep))
+            self._index(self._layers[0], dep.name)
             return
 
         if level is not None:
             if level < len(self._layers):
-                self._layers[level].add(dep)
+                layer = self._layers[level]
+                layer.add(dep)
             else:
                 layer = Layer(level, dep)
                 self._layers.append(layer)
-                self._deps = self._deps.new_child(layer._mapping)
+            self._index(layer, dep.name)
             return
 
-        parents_names = dep.constraint.sources
-        for layer in self._layers:
-            for parent in layer:
-                if parent.name in parents_names:
-                    return self.add(dep, level=layer.level + 1)
-        raise KeyError('cannot find any parent for dependency: ' + str(dep.name))
+        # put the dep right after the first layer that contains any of its parents
+        levels = [self._lowest_levels[name] for name in dep.constraint.sources if name in self._lowest_levels]
+        if not levels:
+            raise KeyError('cannot find any parent for dependency: ' + str(dep.name))
+        return self.add(dep, level=min(levels) + 1)
+
+    def _index(self, layer: Layer, name: str) -> None:
+        if self._lowest_levels.get(name, layer.level) >= layer.level:
+            self._lowest_levels[name] = layer.level
+        position = self._positions.get(name)
+        # dep from the highest layer shadows deps with the same name from lower layers
+        if position is not None and position[0] > layer.level:
+            return
+        # the first layer can merge deps, so take the actual dep from the layer
+        dep = layer.get(name)
+        self._deps[name] = dep
+        if position is None or position[0] != layer.level:
+            self._positions[name] = (layer.level, next(self._counter))
+        if not dep.applied:
+            self._leafs.add(name)
+
+    def mark_applied(self, dep) -> None:
+        dep.applied = True
+        self._leafs.discard(dep.name)
+
+    def mark_unapplied(self, dep) -> None:
+        dep.applied = False
+        self._leafs.add(dep.name)
 
     def get_leafs(self, level: Optional[int] = None) -> tuple:
         """Get deps that aren't applied yet
         """
-        layers = self._layers
-        if level is not None:
-            layers = layers[:level + 1]
-
         result = []
-        for layer in layers:
-            for dep in layer:
-                if not dep.applied and dep.used:
-                    result.append(dep)
+        for name in tuple(self._leafs):
+            dep = self._deps.get(name)
+            if dep is None or dep.applied:
+                self._leafs.discard(name)
+                continue
+            if not dep.used:
+                continue
+            if level is not None and self._positions[name][0] > level:
+                continue
+            result.append(dep)
+        result.sort(key=lambda dep: self._positions[dep.name])
         return tuple(result)
 
     def get_layer(self, dep_or_level) -> Layer:
         if isinstance(dep_or_level, int):
             return self._layers[dep_or_level]
 
-        dep = dep_or_level
-        for layer in reversed(self._layers):
-            if dep in layer:
+        name = dep_or_level.name
+        position = self._positions.get(name)
+        # layers can be dropped from outside (see `deps convert`)
+        if position is not None and position[0] < len(self._layers):
+            layer = self._layers[position[0]]
+            if name in layer:
                 return layer
-
         raise KeyError('cannot find dep')
 
     def get(self, name: str):
-        if name in self._deps:
-            return self._deps[name]
-        for layer in reversed(self._layers):
-            dep = layer.get(name)
-            if dep is not None:
-                return dep
+        return self._deps.get(name)
 
     def get_children(self, dep) -> dict:
         """Get all children of dependency that already represented in graph.
         """
+        result: Dict[str, Any] = dict()
         if not dep.locked:
-            return dict()
-        result = dict()
-        for child in dep.dependencies:
-            layer = self.get_layer(child)
-            if layer is None:
+            return result
+        # every dep is expanded only once, it also breaks recursive deps
+        seen = {dep.name}
+        # stack of iterators instead of recursion to keep deep graphs
+        # away from the recursion limit and keep children in depth-first order
+        stack = [iter(dep.dependencies)]
+        while stack:
+            child = next(stack[-1], None)
+            if child is None:
+                stack.pop()
                 continue
-            if child.name in result:
-                logger.warning('Recursive dependency: {dep}', extra=dict(dep=child.name))
-            else:
-                result[child.name] = self.get(name=child.name)
-            result.update(self.get_children(child))
+            # skip children that aren't represented in graph
+            if child.name not in self._deps:
+                continue
+            result[child.name] = self.get(name=child.name)
+            if child.name in seen or not child.locked:
+                continue
+            seen.add(child.name)
+            stack.append(iter(child.dependencies))
         return result
 
     def get_parents(self, *deps, avoid: Optional[list] = None) -> dict:
-        if avoid is None:
-            avoid = []
+        """Get all deps in graph that directly or indirectly depend on the given deps.
+        """
+        reverse = self._build_reverse_index()
+        visited = set(avoid or ())
+        queue = deque(dep.name for dep in deps)
 
         parents = dict()
-        for dep in deps:
-            for layer in self._layers:
-                for parent in layer:
-                    was_locked = parent.locked
-                    for children in parent.dependencies:
-                        if children.name != dep.name:
-                            continue
-                        if children.name in avoid:
-                            continue
-                        parents[parent.name] = parent
-                        break
-                    # if dependency hasn't been locked then unlock it after our accidental lock
-                    if parent.locked and not was_locked:
-                        parent.unlock()
-        if parents:
-            parents.update(self.get_parents(
-                *parents.values(),
-                avoid=avoid + [dep.name for dep in deps],
-            ))
+        while queue:
+            name = queue.popleft()
+            if name in visited:
+                continue
+            visited.add(name)
+            for parent in reverse.get(name, ()):
+                parents[parent.name] = parent
+                queue.append(parent.name)
         return parents
 
+    def _build_reverse_index(self) -> Dict[str, List[Dependency]]:
+        """Map every dep name to the deps in graph that depend on it.
+
+        The index isn't cached: deps of a dep depend on the chosen group,
+        and it can be changed by mutator without touching the graph.
+        """
+        reverse: Dict[str, List[Dependency]] = defaultdict(list)
+        for layer in self._layers:
+            for parent in layer:
+                was_locked = parent.locked
+                for child in parent.dependencies:
+                    reverse[child.name].append(parent)
+                # if dependency hasn't been locked then unlock it after our accidental lock
+                if parent.locked and not was_locked:
+                    parent.unlock()
+        return reverse
+
     def fast_apply(self) -> bool:
         """Apply only the first layer.
         """
@@ -204,39 +289,56 @@ class Graph:
             return False
         for root in self._roots:
             for dep in root.dependencies:
-                dep.applied = True
+                self.mark_applied(dep)
                 self.add(dep)
         for root in self._roots:
-            root.applied = True
+            self.mark_applied(root)
         return True
 
     def draw(self, path: str = '.dephell_report', suffix: str = '') -> None:
-        dot = graphviz.Digraph(
-            name=self._roots[0].name + suffix,
-            directory=path,
-            format='png',
-        )
-        first_deps = self._layers[1]
+        # DOT text is built by hand: it's much faster on big graphs
+        # than calling Digraph.node and Digraph.edge for every item.
+        name = self._roots[0].name + suffix
+        first_names = self._layers[1]._mapping
+        conflict_name = self.conflict.name if self.conflict else None
+        lines = ['digraph {} {{'.format(_quote(name))]
 
         # add root nodes
         for root in self._roots:
-            dot.node(root.name, root.raw_name, color='blue')
+            lines.append('\t{} [label={} color=blue]'.format(_quote(root.name), _quote(root.raw_name)))
 
-        # add nodes
+        # add nodes and collect edges in one pass over deps
+        edges = []
         for dep in self:
             # https://graphviz.gitlab.io/_pages/doc/info/colors.html
-            if self.conflict and dep.name == self.conflict.name:
+            if dep.name == conflict_name:
                 color = 'crimson'
-            elif dep in first_deps:
+            elif dep.name in first_names:
                 color = 'forestgreen'
             else:
                 color = 'black'
-            dot.node(dep.name, dep.raw_name + str(dep.constraint), color=color)
+            dep_name = _quote(dep.name)
+            lines.append('\t{} [label={} color={}]'.format(
+                dep_name,
+                _quote(dep.raw_name + str(dep.constraint)),
+                color,
+            ))
+            for parent, constraint in dep.constraint.specs:
+                edges.append('\t{} -> {} [label={}]'.format(
+                    _quote(parent),
+                    dep_name,
+                    _quote(str(constraint)),
+                ))
 
         # add edges
-        for dep in self:
-            for parent, constraint in dep.constraint.specs:
-                dot.edge(parent, dep.name, label=constraint)
+        lines.extend(edges)
+        lines.append('}')
+        dot = graphviz.Source(
+            '\n'.join(lines) + '\n',
+            filename=name + '.gv',
+            directory=path,
+            format='png',
+        )
 
         # save files
         try:
@@ -248,11 +350,11 @@ class Graph:
 
     @property
     def names(self) -> set:
-        return set(self._deps.keys())
+        return set(self._deps)
 
     @property
     def deps(self) -> tuple:
-        return tuple(dep for dep in self._deps.values() if dep not in self._roots)
+        return tuple(self._iter_deps())
 
     @property
     def applied(self) -> bool:
@@ -262,15 +364,27 @@ class Graph:
     def metainfo(self) -> RootDependency:
         return RootDependency.get_metainfo(*self._roots)
 
+    def _iter_deps(self) -> Iterator:
+        # walk layers to yield deps in layers order, like ChainMap did
+        root_ids = self._root_ids
+        for layer in self._layers:
+            for dep in layer:
+                if self._deps.get(dep.name) is dep and id(dep) not in root_ids:
+                    yield dep
+
     # magic
 
     def __iter__(self) -> Iterator:
+        # iterate over a snapshot, the resolver adds deps into graph while iterating
         return iter(self.deps)
 
     def __contains__(self, dep) -> bool:
         if isinstance(dep, str):
-            return dep in self.names
-        return dep in self.deps
+            return dep in self._deps
+        other = self._deps.get(dep.name)
+        if other is None or id(other) in self._root_ids:
+            return False
+        return other == dep
 
     def __repr__(self):
         roots = [str(root) for root in self._roots]
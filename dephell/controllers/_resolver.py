@@ -58,7 +58,7 @@ class Resolver:
             # check
             if not other_dep.compat:
                 return other_dep
-        parent.applied = True
+        self.graph.mark_applied(parent)
 
     def unapply(self, dep, *, force: bool = True, soft: bool = False) -> None:
         """
@@ -69,7 +69,7 @@ class Resolver:
             return
         # it must be before actual unapplying to avoid recursion on circular dependencies
         if not soft:
-            dep.applied = False
+            self.graph.mark_unapplied(dep)
 
         for child in dep.dependencies:
             child_name = child.name
@@ -170,7 +170,7 @@ class Resolver:
             # deps that won't be unapplied.
             if deep:
                 self.unapply(dep, soft=True)
-            dep.applied = False
+            self.graph.mark_unapplied(dep)
 
         # Some child deps can be unapplied from other child deps, but we need them.
         # For example, if we need A, but don't need B, and A and B depends on C,
@@ -183,7 +183,7 @@ class Resolver:
             logger.debug('reapply', extra=dict(dep=dep.name, envs=envs))
             if deep:
                 self.apply(dep, recursive=True)
-            dep.applied = True
+            self.graph.mark_applied(dep)
 
     def apply_markers(self, python) -> None:
         implementation = python.implementation
@@ -211,7 +211,7 @@ class Resolver:
                 continue
 
             self.unapply(dep, soft=True)
-            dep.applied = False
+            self.graph.mark_unapplied(dep)
 
     def _apply_deps(self, deps, debug: bool = False) -> bool:
         for dep in deps:
@@ -0,0 +1,153 @@
+# built-in
+from unittest.mock import patch
+
+# external
+import pytest
+
+# project
+from dephell.controllers import DependencyMaker, Graph, Mutator, Resolver
+from dephell.models import RootDependency
+
+# app
+from ..helpers import Fake, make_root
+
+
+def make_dep(name: str, source):
+    return DependencyMaker.from_params(raw_name=name, constraint='*', source=source)[0]
+
+
+def test_iterate_in_layers_order():
+    root = RootDependency(raw_name='root')
+    graph = Graph(root)
+    graph.add(make_dep('a', source=root), level=1)
+    graph.add(make_dep('x', source=root), level=2)
+    graph.add(make_dep('y', source=root), level=1)
+    assert [dep.name for dep in graph] == ['a', 'y', 'x']
+    assert [dep.name for dep in graph.deps] == ['a', 'y', 'x']
+
+
+def test_clear_returns_shadowed_dep():
+    # root that depends on itself, like `pkg[all]` extras do
+    root = RootDependency(raw_name='b')
+    root.attach_dependencies([make_dep('b', source=root)])
+    graph = Graph(root)
+    graph.fast_apply()
+    dep = graph.get('b')
+    assert dep is not root
+    assert graph.get_layer(dep).level == 1
+
+    dep.constraint.unapply('b')
+    graph.clear()
+    assert graph.get('b') is root
+    assert graph.names == {'b'}
+    assert graph.get_layer(root).level == 0
+
+
+def test_add_after_lowest_parent_when_shadowed():
+    # the root `b` is shadowed by its own dependency `b` from the first layer,
+    # but `c` is still a direct dependency of the root.
+    root = RootDependency(raw_name='b')
+    root.attach_dependencies([make_dep('b', source=root), make_dep('c', source=root)])
+    graph = Graph(root)
+    graph.fast_apply()
+    assert [(layer.level, sorted(dep.name for dep in layer)) for layer in graph._layers] == [
+        (0, ['b']),
+        (1, ['b', 'c']),
+    ]
+    assert graph.get_layer(graph.get('c')).level == 1
+
+
+def test_get_layer_after_layers_dropped():
+    root = RootDependency(raw_name='root')
+    graph = Graph(root)
+    dep = make_dep('a', source=root)
+    graph.add(dep, level=1)
+    graph.add(make_dep('b', source=root), level=2)
+    assert graph.get_layer(dep).level == 1
+
+    graph._layers = graph._layers[:2]
+    assert graph.get_layer(dep).level == 1
+    with pytest.raises(KeyError):
+        graph.get_layer(graph.get('b'))
+
+
+def test_draw():
+    graphviz = pytest.importorskip('graphviz')
+    root = make_root(
+        root=Fake('', 'a>=1', 'b'),
+        a=(Fake('1.0', 'b<2', 'c'),),
+        b=(Fake('1.0'), Fake('2.0')),
+        c=(Fake('1.0', 'b'),),
+    )
+    resolver = Resolver(graph=Graph(root), mutator=Mutator())
+    with patch(target='dephell.controllers._dependency.get_repo', return_value=root.repo):
+        assert resolver.resolve(silent=True)
+    resolver.graph.conflict = resolver.graph.get('c')
+
+    sources = []
+    with patch.object(graphviz.Source, 'render', autospec=True, side_effect=sources.append):
+        resolver.graph.draw(suffix='"1')
+    assert len(sources) == 1
+    assert sources[0].filename == 'abc"1.gv'
+    assert sources[0].source == '\n'.join([
+        'digraph "abc\\"1" {',
+        '\t"abc" [label="abc" color=blue]',
+        '\t"a" [label="a>=1" color=forestgreen]',
+        '\t"b" [label="b<2" color=forestgreen]',
+        '\t"c" [label="c" color=crimson]',
+        '\t"abc" -> "a" [label=">=1"]',
+        '\t"a" -> "b" [label="<2"]',
+        '\t"abc" -> "b" [label=""]',
+        '\t"c" -> "b" [label=""]',
+        '\t"a" -> "c" [label=""]',
+        '}',
+        '',
+    ])
+
+
+class FakeDep:
+    applied = False
+    used = True
+
+    def __init__(self, name: str, locked: bool = True):
+        self.name = name
+        self.locked = locked
+        self.dependencies = ()
+
+    def __repr__(self):
+        return 'FakeDep({})'.format(self.name)
+
+
+def make_children_graph(*deps):
+    graph = Graph(RootDependency(raw_name='root'))
+    for dep in deps:
+        graph.add(dep, level=1)
+    return graph
+
+
+def test_get_children_diamond():
+    a, b, c, d = (FakeDep(name) for name in 'abcd')
+    a.dependencies = (b, c)
+    b.dependencies = (d, )
+    c.dependencies = (d, )
+    graph = make_children_graph(a, b, c, d)
+    children = graph.get_children(a)
+    assert list(children) == ['b', 'd', 'c']
+    assert children['d'] is d
+
+
+def test_get_children_cycle():
+    a, b = FakeDep('a'), FakeDep('b')
+    a.dependencies = (b, )
+    b.dependencies = (a, )
+    graph = make_children_graph(a, b)
+    assert list(graph.get_children(a)) == ['b', 'a']
+
+
+def test_get_children_unlocked_and_missing():
+    a, b, c = FakeDep('a'), FakeDep('b', locked=False), FakeDep('c')
+    a.dependencies = (b, FakeDep('missing'))
+    b.dependencies = (c, )
+    graph = make_children_graph(a, b, c)
+    assert list(graph.get_children(a)) == ['b']
+    assert graph.get_children(b) == dict()
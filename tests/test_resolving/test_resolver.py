@@ -1,3 +1,9 @@
+# built-in
+from unittest.mock import patch
+
+# project
+from dephell.controllers import Graph, Mutator, Resolver
+
 # app
 from ..helpers import Fake, check, make_root
 
@@ -242,3 +248,29 @@ def test_cyclic_dependencies_with_unapply():
         ),
     )
     check(root=root, a='==1', b='==1', c='==1')
+
+
+def test_unapply_returns_dep_to_leafs():
+    root = make_root(
+        root=Fake('', 'a'),
+        a=(
+            Fake('1.0', 'b'),
+        ),
+        b=(
+            Fake('1.0'),
+        ),
+    )
+    resolver = Resolver(graph=Graph(root), mutator=Mutator())
+    with patch(target='dephell.controllers._dependency.get_repo', return_value=root.repo):
+        assert resolver.resolve(silent=True)
+        assert resolver.graph.get_leafs() == ()
+
+        dep = resolver.graph.get('a')
+        resolver.unapply(dep)
+        assert not dep.applied
+        assert [leaf.name for leaf in resolver.graph.get_leafs()] == ['a']
+
+        assert resolver.resolve(silent=True)
+    assert dep.applied
+    assert resolver.graph.get('b').applied
+    assert resolver.graph.get_leafs() == ()